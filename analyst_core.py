@@ -0,0 +1,337 @@
+"""Shared data fetching and formatting for the Streamlit app and the digest bot"""
+import os
+import time
+import sqlite3
+import threading
+import functools
+import diskcache
+import yfinance as yf
+import numpy as np
+import pandas as pd
+from yfinance.exceptions import YFDataException
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+YF_WORKERS = int(os.getenv("YF_WORKERS", "8"))
+FINNHUB_RATE_LIMIT = float(os.getenv("FINNHUB_RATE_LIMIT", "30"))  # calls per second
+
+# On-disk cache so per-symbol fetches survive restarts; analyst data changes at most
+# a few times a day, so an hour is a safe default. DISK_CACHE_TTL=0 turns it off
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", "/tmp/analyst_ratings")
+DISK_CACHE_TTL = int(os.getenv("DISK_CACHE_TTL", "3600"))
+
+try:
+    disk_cache = diskcache.Cache(DISK_CACHE_DIR) if DISK_CACHE_TTL > 0 else None
+except (OSError, sqlite3.Error) as e:
+    # An unusable cache directory only costs speed - fall back to fetching every time
+    print(f"Disk cache disabled, {DISK_CACHE_DIR} unusable: {e}")
+    disk_cache = None
+
+# quoteSummary modules holding the info fields we read, and the fields themselves
+INFO_MODULES = ['price', 'financialData']
+INFO_KEYS = ['longName', 'shortName', 'recommendationKey', 'targetMeanPrice']
+
+# Finnhub recommendation trend keys, bullish ones first
+RATING_KEYS = ['strongBuy', 'buy', 'hold', 'sell', 'strongSell']
+
+# yfinance upgrades_downgrades columns -> display names (price target columns
+# come back lower camel case from current yfinance releases)
+COLUMN_RENAME = {
+    'GradeDate': 'Date',
+    'Firm': 'Firm',
+    'ToGrade': 'To Grade',
+    'FromGrade': 'From Grade',
+    'Action': 'Action',
+    'PriceTargetAction': 'Price Target Action',
+    'CurrentPriceTarget': 'Current Price Target',
+    'PriorPriceTarget': 'Prior Price Target',
+    'priceTargetAction': 'Price Target Action',
+    'currentPriceTarget': 'Current Price Target',
+    'priorPriceTarget': 'Prior Price Target'
+}
+
+ACTION_MAP = {
+    'main': 'Maintains',
+    'up': 'Upgrade',
+    'down': 'Downgrade',
+    'init': 'Initiates',
+    'reit': 'Reiterates'
+}
+
+PT_ACTION_MAP = {
+    'up': 'Raises',
+    'down': 'Lowers',
+    'init': 'Announces',
+    'main': 'Maintains',
+    'reit': 'Reiterates'
+}
+
+# Display column order - Action right after Firm
+COLUMN_ORDER = ['Date', 'Firm', 'Action', 'To Grade', 'From Grade',
+                'Price Target Action', 'Current Price Target', 'Prior Price Target']
+
+def parse_dates(col):
+    """Return a datetime column, parsing ISO8601 strings only when needed"""
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col
+    return pd.to_datetime(col, format='ISO8601', cache=True)
+
+def format_price(col):
+    """Format a price target column as currency, with N/A for missing values"""
+    values = pd.to_numeric(col, errors='coerce')
+    return values.map('${:,.2f}'.format).mask(values.isna(), 'N/A')
+
+def since(actions, cutoff):
+    """Rows of a date-indexed frame at or after cutoff, binary-searching sorted indexes"""
+    index = actions.index
+    if index.is_monotonic_increasing:
+        return actions.iloc[index.searchsorted(cutoff, side='left'):]
+    if index.is_monotonic_decreasing:
+        return actions.iloc[:len(index) - index[::-1].searchsorted(cutoff, side='left')]
+    return actions[index >= cutoff]
+
+def worth_storing(result):
+    """Whether a fetch result can be persisted - no errors and no empty frame or dict"""
+    # yfinance logs HTTP errors and returns empty data by default, so an outage looks like a
+    # symbol without coverage; those are cheap to refetch, so neither is kept on disk
+    return not any(isinstance(part, Exception) or
+                   (isinstance(part, (pd.DataFrame, dict)) and len(part) == 0) for part in result)
+
+def disk_cached(func):
+    """Persist successful per-symbol fetches on disk; failed or empty results are never stored"""
+    if disk_cache is None:
+        return func
+    
+    @functools.wraps(func)
+    def wrapper(sym, *args):
+        key = (func.__name__, sym)
+        result = disk_cache.get(key)
+        if result is None:
+            result = func(sym, *args)
+            if worth_storing(result):
+                disk_cache.set(key, result, expire=DISK_CACHE_TTL)
+        return result
+    
+    return wrapper
+
+def fetch_info(ticker):
+    """Fetch the info fields we use, requesting only the quoteSummary modules that hold them"""
+    try:
+        result = ticker._quote._fetch(INFO_MODULES)
+        info = {}
+        for module in result['quoteSummary']['result'][0].values():
+            if isinstance(module, dict):
+                info.update(module)
+    except Exception:
+        info = ticker.info
+    
+    # Keep cached payloads small - both tabs only read these keys
+    return {k: info[k] for k in INFO_KEYS if k in info}
+
+def fetch_upgrades_downgrades(ticker):
+    """Fetch upgrades/downgrades, treating a symbol with no analyst coverage as having none"""
+    try:
+        return ticker.upgrades_downgrades
+    except YFDataException as e:
+        # ETFs and uncovered small caps always raise this - it is not a failure to retry
+        if 'No upgrade/downgrade history' in str(e):
+            return pd.DataFrame()
+        raise
+
+def safe_call(func, *args):
+    """Call func, returning (result, None) or (None, exception) instead of raising"""
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, e
+
+@disk_cached
+def fetch_symbol(sym):
+    """Fetch info and upgrades/downgrades for a single symbol - each call can fail on its own"""
+    ticker, error = safe_call(yf.Ticker, sym)
+    if error is not None:
+        return sym, None, None, error, error
+    info, info_error = safe_call(fetch_info, ticker)
+    actions, actions_error = safe_call(fetch_upgrades_downgrades, ticker)
+    return sym, info, actions, info_error, actions_error
+
+@disk_cached
+def fetch_actions(sym):
+    """Fetch upgrades/downgrades for a single symbol"""
+    try:
+        return sym, fetch_upgrades_downgrades(yf.Ticker(sym)), None
+    except Exception as e:
+        return sym, None, e
+
+def pool_size(tasks):
+    """Worker count for a batch of network calls - never more threads than tasks"""
+    return max(1, min(YF_WORKERS, tasks))
+
+@disk_cached
+def fetch_trends(sym, recommendation_trends):
+    """Fetch Finnhub recommendation trends for a single symbol"""
+    try:
+        return recommendation_trends(sym), None
+    except Exception as e:
+        return None, e
+
+def rate_limited(func, calls_per_second):
+    """Wrap func so no more than calls_per_second calls start in any sliding one-second window"""
+    # Sub-1/s limits become one call per 1/calls_per_second seconds
+    window = max(1.0, 1.0 / calls_per_second)
+    limit = max(1, int(calls_per_second * window))
+    starts = deque()
+    lock = threading.Lock()
+    
+    def wrapper(*args, **kwargs):
+        while True:
+            with lock:
+                now = time.monotonic()
+                while starts and now - starts[0] >= window:
+                    starts.popleft()
+                if len(starts) < limit:
+                    starts.append(now)
+                    break
+                wait = window - (now - starts[0])
+            time.sleep(wait)
+        return func(*args, **kwargs)
+    
+    return wrapper
+
+def fetch_all_analyst_actions(symbols, fh=None, on_progress=None):
+    """Fetch info, analyst actions and Finnhub recommendation trends for all symbols - call once and reuse"""
+    all_actions = {}
+    
+    recommendation_trends = rate_limited(fh.recommendation_trends, FINNHUB_RATE_LIMIT) if fh is not None else None
+    
+    # One pool per service, so neither waits on the other's queue and Finnhub's rate-limit
+    # sleeps never hold a Yahoo worker
+    with ThreadPoolExecutor(max_workers=pool_size(len(symbols))) as yahoo_executor, \
+         ThreadPoolExecutor(max_workers=pool_size(len(symbols))) as finnhub_executor:
+        yahoo_futures = [yahoo_executor.submit(fetch_symbol, sym) for sym in symbols]
+        finnhub_futures = [finnhub_executor.submit(fetch_trends, sym, recommendation_trends)
+                           for sym in symbols] if recommendation_trends is not None else []
+        
+        # Report progress from the calling thread as requests finish, in completion order
+        if on_progress is not None:
+            total = len(yahoo_futures) + len(finnhub_futures)
+            for done, _ in enumerate(as_completed(yahoo_futures + finnhub_futures), start=1):
+                on_progress(done, total)
+        
+        for i, yahoo_future in enumerate(yahoo_futures):
+            sym, info, actions, info_error, actions_error = yahoo_future.result()
+            trends, trends_error = finnhub_futures[i].result() if finnhub_futures else (None, None)
+            
+            # Keep whatever succeeded; a failed half comes back as None
+            entry = {
+                'company_name': (info or {}).get('longName', (info or {}).get('shortName', sym)),
+                'info': info or {},
+                'actions': actions if actions is not None else pd.DataFrame(),
+                'recommendations': trends or []
+            }
+            if info_error is not None:
+                entry['info_error'] = str(info_error)
+            if actions_error is not None:
+                entry['error'] = str(actions_error)
+            if trends_error is not None:
+                entry['recommendations_error'] = str(trends_error)
+            all_actions[sym] = entry
+    
+    return all_actions
+
+def full_ratings(symbols, analyst_actions_data):
+    """Build analyst ratings for given stock symbols from prefetched data - returns (ratings, errors by symbol)"""
+    rated_symbols, companies, consensus, target_prices, trends = [], [], [], [], []
+    errors = {}
+    
+    for sym in symbols:
+        prefetched = analyst_actions_data.get(sym, {})
+        info_error = prefetched.get('info_error')
+        trends_error = prefetched.get('recommendations_error')
+        if info_error or trends_error:
+            errors[sym] = info_error or trends_error
+            # Show a partial row unless both sources failed
+            if info_error and trends_error:
+                continue
+        
+        info = prefetched.get('info', {})
+        fh_ratings_list = prefetched.get('recommendations', [])
+        
+        rated_symbols.append(sym)
+        companies.append(info.get('longName', info.get('shortName', 'N/A')))
+        # 'or' also covers a recommendationKey present but null
+        consensus.append((info.get('recommendationKey') or 'N/A').replace('_', ' ').title())
+        target_prices.append(info.get('targetMeanPrice') or np.nan)
+        trends.append(fh_ratings_list[0] if fh_ratings_list else {})
+    
+    if not rated_symbols:
+        return pd.DataFrame(), errors
+    
+    # Roll up analyst counts for all symbols at once; missing keys count as zero
+    counts = pd.DataFrame(trends, columns=RATING_KEYS).fillna(0).to_numpy(dtype=np.int32)
+    totals = counts.sum(axis=1)
+    bullish = np.divide((counts[:, 0] + counts[:, 1]) * 100.0, totals,
+                        out=np.zeros(len(totals)), where=totals > 0).round(1)
+    
+    # Assemble column-wise from typed arrays rather than inferring dtypes from row dicts
+    df = pd.DataFrame({
+        'Symbol': rated_symbols,
+        'Company': companies,
+        'Consensus': consensus,
+        'Strong Buy': counts[:, 0],
+        'Buy': counts[:, 1],
+        'Hold': counts[:, 2],
+        'Sell': counts[:, 3],
+        '% Bullish': bullish,
+        'Target Price': np.array(target_prices, dtype=np.float64)
+    })
+    
+    return df, errors
+
+def process_actions_for_display(df_actions, date_format='%Y-%m-%d', include_symbol=False, newest_first=False,
+                                format_prices=True):
+    """Process raw actions dataframe for display, optionally keeping a leading Symbol column"""
+    if df_actions.empty:
+        return pd.DataFrame()
+    
+    # Build the display frame in one go from the (Symbol, Date) index levels and renamed
+    # columns, rather than reset_index -> rename -> re-parse
+    index = df_actions.index
+    data = {}
+    if index.nlevels > 1:
+        data['Symbol'] = index.get_level_values(0)
+    data['Date'] = parse_dates(index.get_level_values(-1))
+    for col in df_actions.columns:
+        data[COLUMN_RENAME.get(col, col)] = df_actions[col].to_numpy()
+    display_df = pd.DataFrame(data)
+    
+    # Sort on the parsed timestamps, then format date
+    if newest_first:
+        display_df = display_df.sort_values('Date', ascending=False, ignore_index=True)
+    display_df['Date'] = display_df['Date'].dt.strftime(date_format)
+    
+    # Replace action codes with meaningful text
+    if 'Action' in display_df.columns:
+        display_df['Action'] = display_df['Action'].replace(ACTION_MAP)
+    
+    # Replace price target action codes
+    if 'Price Target Action' in display_df.columns:
+        display_df['Price Target Action'] = display_df['Price Target Action'].replace(PT_ACTION_MAP)
+    
+    # Format price targets as currency, or leave them numeric for client-side formatting
+    price_format = format_price if format_prices else (lambda col: pd.to_numeric(col, errors='coerce'))
+    if 'Current Price Target' in display_df.columns:
+        display_df['Current Price Target'] = price_format(display_df['Current Price Target'])
+    if 'Prior Price Target' in display_df.columns:
+        display_df['Prior Price Target'] = price_format(display_df['Prior Price Target'])
+    
+    # Low-cardinality text columns are cheaper to store and serialize as categories
+    for col in ['Symbol', 'Firm', 'Action', 'To Grade', 'From Grade', 'Price Target Action']:
+        if col in display_df.columns:
+            display_df[col] = display_df[col].astype('category')
+    
+    # Select columns - Action right after Firm
+    column_order = ['Symbol'] + COLUMN_ORDER if include_symbol else COLUMN_ORDER
+    display_df = display_df[[col for col in column_order if col in display_df.columns]]
+    
+    return display_df
@@ -1,7 +1,10 @@
 import os
 import resend
-import yfinance as yf
+import numpy as np
 import pandas as pd
+import analyst_core as core
+from pandas.io.formats.style import Styler
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # Configuration
@@ -9,87 +12,93 @@ resend.api_key = os.getenv("RESEND_API_KEY")
 EMAIL_TO = os.getenv("EMAIL_TO")
 EMAIL_FROM = os.getenv("EMAIL_FROM")
 SYMBOLS = [s.strip().upper() for s in os.getenv("SYMBOLS", "AAPL").split(",")]
+SEND_EMPTY_DIGESTS = os.getenv("SEND_EMPTY_DIGESTS", "false").lower() in ("1", "true", "yes")
+
+# Digest table columns -> email header labels
+EMAIL_HEADERS = {
+    'Symbol': 'Symbol',
+    'Date': 'Date',
+    'Firm': 'Firm',
+    'Action': 'Action',
+    'To Grade': 'To Grade',
+    'From Grade': 'From Grade',
+    'Price Target Action': 'PT Action',
+    'Current Price Target': 'Current PT',
+    'Prior Price Target': 'Prior PT'
+}
 
 def get_analyst_actions():
     """Get all analyst actions from last 24 hours"""
-    all_actions = []
+    frames = {}
     cutoff_time = datetime.now() - timedelta(hours=24)
     
-    for sym in SYMBOLS:
-        try:
-            ticker = yf.Ticker(sym)
-            actions = ticker.upgrades_downgrades
-            
-            if actions is not None and not actions.empty:
-                recent = actions[actions.index >= cutoff_time]
-                if not recent.empty:
-                    df = recent.reset_index()
-                    df.insert(0, 'Symbol', sym)
-                    all_actions.append(df)
-        except Exception as e:
-            print(f"Error fetching {sym}: {e}")
-    
-    if not all_actions:
-        return pd.DataFrame()
-    
-    combined = pd.concat(all_actions, ignore_index=True)
-    combined.columns = ['Symbol', 'Date', 'Firm', 'To Grade', 'From Grade', 'Action', 
-                       'Price Target Action', 'Current Price Target', 'Prior Price Target'][:len(combined.columns)]
+    # Symbols are independent and the fetch is network-bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=core.pool_size(len(SYMBOLS))) as executor:
+        results = list(executor.map(core.fetch_actions, SYMBOLS))
     
-    combined['Date'] = pd.to_datetime(combined['Date']).dt.strftime('%Y-%m-%d %H:%M')
+    for sym, actions, error in results:
+        if error is not None:
+            print(f"Error fetching {sym}: {error}")
+        elif actions is not None and not actions.empty:
+            recent = core.since(actions, cutoff_time)
+            if not recent.empty:
+                frames[sym] = recent
     
-    action_map = {'main': 'Maintains', 'up': 'Upgrade', 'down': 'Downgrade', 'init': 'Initiates', 'reit': 'Reiterates'}
-    if 'Action' in combined.columns:
-        combined['Action'] = combined['Action'].map(action_map).fillna(combined['Action'])
-    
-    if 'Price Target Action' in combined.columns:
-        pt_map = {'up': 'Raises', 'down': 'Lowers', 'init': 'Announces', 'main': 'Maintains', 'reit': 'Reiterates'}
-        combined['Price Target Action'] = combined['Price Target Action'].map(pt_map).fillna(combined['Price Target Action'])
-    
-    if 'Current Price Target' in combined.columns:
-        combined['Current Price Target'] = combined['Current Price Target'].apply(lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A')
-    if 'Prior Price Target' in combined.columns:
-        combined['Prior Price Target'] = combined['Prior Price Target'].apply(lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A')
+    if not frames:
+        return pd.DataFrame()
     
-    return combined.sort_values('Date', ascending=False).reset_index(drop=True)
+    # Concatenate once keyed by symbol so the display frame gets a leading Symbol column
+    return core.process_actions_for_display(pd.concat(frames, names=['Symbol'], copy=False),
+                                            date_format='%Y-%m-%d %H:%M', include_symbol=True, newest_first=True)
+
+def _cell_classes(table):
+    """CSS classes per cell - bold symbols, upgrades in green and downgrades in red"""
+    classes = pd.DataFrame('', index=table.index, columns=table.columns)
+    classes['Symbol'] = 'symbol'
+    action = table['Action']
+    classes['Action'] = np.where(action.str.contains('Upgrade'), 'upgrade',
+                                 np.where(action.str.contains('Downgrade'), 'downgrade', ''))
+    return classes
 
 def create_html_email(df):
     """Create HTML email from dataframe"""
     if df.empty:
         return "<p>No analyst actions in the last 24 hours.</p>"
     
-    html = f"""<html><head><style>
+    table = (df.reindex(columns=list(EMAIL_HEADERS), fill_value='N/A')
+               .astype(object)
+               .fillna('N/A')
+               .astype(str)
+               .rename(columns=EMAIL_HEADERS))
+    
+    # Let pandas render the table, styling cells through the class rules in <head> -
+    # many mail clients strip the id attributes and ID selectors Styler uses otherwise
+    styler = (Styler(table, cell_ids=False)
+              .set_td_classes(_cell_classes(table))
+              .format(escape='html')
+              .hide(axis='index'))
+    
+    return f"""<html><head><style>
         body {{ font-family: Arial, sans-serif; }}
         h2 {{ color: #1f77b4; }}
         table {{ border-collapse: collapse; width: 100%; margin: 20px 0; }}
         th {{ background-color: #1f77b4; color: white; padding: 12px; text-align: left; }}
         td {{ padding: 10px; border-bottom: 1px solid #ddd; }}
         tr:hover {{ background-color: #f5f5f5; }}
+        .symbol {{ font-weight: bold; }}
         .upgrade {{ color: #28a745; font-weight: bold; }}
         .downgrade {{ color: #dc3545; font-weight: bold; }}
     </style></head><body>
         <h4>Analyst Actions - Last 24 Hours</h2>
-        <table><tr><th>Symbol</th><th>Date</th><th>Firm</th><th>Action</th><th>To Grade</th><th>From Grade</th><th>PT Action</th><th>Current PT</th><th>Prior PT</th></tr>"""
-    
-    for _, row in df.iterrows():
-        action_class = 'upgrade' if 'Upgrade' in str(row.get('Action', '')) else 'downgrade' if 'Downgrade' in str(row.get('Action', '')) else ''
-        html += f"""<tr>
-            <td><strong>{row.get('Symbol', 'N/A')}</strong></td>
-            <td>{row.get('Date', 'N/A')}</td>
-            <td>{row.get('Firm', 'N/A')}</td>
-            <td class="{action_class}">{row.get('Action', 'N/A')}</td>
-            <td>{row.get('To Grade', 'N/A')}</td>
-            <td>{row.get('From Grade', 'N/A')}</td>
-            <td>{row.get('Price Target Action', 'N/A')}</td>
-            <td>{row.get('Current Price Target', 'N/A')}</td>
-            <td>{row.get('Prior Price Target', 'N/A')}</td>
-        </tr>"""
-    
-    return html + "</table></body></html>"
+        {styler.to_html()}</body></html>"""
 
 def send_digest():
     """Fetch actions and send email digest"""
     actions = get_analyst_actions()
+    if actions.empty and not SEND_EMPTY_DIGESTS:
+        print("ℹ️ No actions in the last 24 hours; skipping send")
+        return True
+    
     subject = f"📊 Analyst Digest - {len(actions)} Actions in Last 24H" if not actions.empty else "📊 Analyst Digest - No Actions Today"
     
     try:
@@ -1,8 +1,9 @@
 import os
 import finnhub
-import yfinance as yf
 import streamlit as st
 import pandas as pd
+import analyst_core as core
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 
 # Streamlit app configuration
@@ -31,156 +32,105 @@ if not finnhub_api_key:
     st.stop()
 
 symbols_str = os.getenv("SYMBOLS")
-symbols = [s.strip().upper() for s in symbols_str.split(",")]
+symbols = tuple(s.strip().upper() for s in symbols_str.split(","))
 
-def full_ratings(symbols):
-    """Fetch analyst ratings for given stock symbols"""
-    data = []
-    fh = finnhub.Client(api_key=finnhub_api_key)
-    
-    for sym in symbols:
-        try:
-            ticker = yf.Ticker(sym)
-            info = ticker.info
-            
-            fh_ratings_list = fh.recommendation_trends(sym)
-            fh_ratings = fh_ratings_list[0] if fh_ratings_list else {}
-            
-            total_analysts = sum([
-                fh_ratings.get(k, 0) 
-                for k in ['strongBuy', 'buy', 'hold', 'sell', 'strongSell']
-            ])
-            
-            bullish_pct = (
-                (fh_ratings.get('strongBuy', 0) + fh_ratings.get('buy', 0)) 
-                / total_analysts * 100
-            ) if total_analysts > 0 else 0
-            
-            data.append({
-                'Symbol': sym,
-                'Company': info.get('longName', info.get('shortName', 'N/A')),
-                'Consensus': info.get('recommendationKey', 'N/A').replace('_', ' ').title(),
-                'Strong Buy': fh_ratings.get('strongBuy', 0),
-                'Buy': fh_ratings.get('buy', 0),
-                'Hold': fh_ratings.get('hold', 0),
-                'Sell': fh_ratings.get('sell', 0),
-                '% Bullish': round(bullish_pct, 1),
-                'Target Price': f"${info.get('targetMeanPrice', 0):.2f}" if info.get('targetMeanPrice') else 'N/A'
-            })
-        except Exception as e:
-            st.warning(f"⚠️ Error fetching data for {sym}: {str(e)}")
-            
-    return pd.DataFrame(data)
+# Ratings change a few times a day at most; reruns within this window reuse cached data
+cache_ttl = int(os.getenv("CACHE_TTL", "600"))
+# Symbols that failed are retried on their own, at most this often
+retry_ttl = int(os.getenv("RETRY_TTL", "60"))
 
-def fetch_all_analyst_actions(symbols):
-    """Fetch all analyst actions for all symbols - call once and reuse"""
-    all_actions = {}
-    
-    for sym in symbols:
-        try:
-            ticker = yf.Ticker(sym)
-            info = ticker.info
-            company_name = info.get('longName', info.get('shortName', sym))
-            actions = ticker.upgrades_downgrades
-            
-            all_actions[sym] = {
-                'company_name': company_name,
-                'actions': actions if actions is not None else pd.DataFrame()
-            }
-        except Exception as e:
-            all_actions[sym] = {
-                'company_name': sym,
-                'actions': pd.DataFrame(),
-                'error': str(e)
-            }
-    
-    return all_actions
+# Column configs are identical on every rerun, so build them once
+SUMMARY_COL_CFG = {
+    "Symbol": st.column_config.TextColumn("Symbol", width="small"),
+    "Company": st.column_config.TextColumn("Company", width="medium"),
+    "Consensus": st.column_config.TextColumn("Consensus"),
+    "Strong Buy": st.column_config.NumberColumn("Strong Buy", format="%d"),
+    "Buy": st.column_config.NumberColumn("Buy", format="%d"),
+    "Hold": st.column_config.NumberColumn("Hold", format="%d"),
+    "Sell": st.column_config.NumberColumn("Sell", format="%d"),
+    "% Bullish": st.column_config.ProgressColumn(
+        "% Bullish",
+        format="%.1f%%",
+        min_value=0,
+        max_value=100,
+    ),
+    "Target Price": st.column_config.NumberColumn("Target Price", format="$%.2f"),
+}
 
-def process_actions_for_display(df_actions, date_format='%Y-%m-%d'):
-    """Process raw actions dataframe for display"""
-    if df_actions.empty:
-        return pd.DataFrame()
-    
-    display_df = df_actions.reset_index()
-    
-    # Build column mapping
-    new_cols = []
-    for i, col in enumerate(display_df.columns):
-        col_lower = str(col).lower()
-        if i == 0 or 'date' in col_lower or 'index' in col_lower:
-            new_cols.append('Date')
-        elif 'firm' in col_lower:
-            new_cols.append('Firm')
-        elif 'tograde' in col_lower or col == 'ToGrade':
-            new_cols.append('To Grade')
-        elif 'fromgrade' in col_lower or col == 'FromGrade':
-            new_cols.append('From Grade')
-        elif 'action' in col_lower and 'price' not in col_lower:
-            new_cols.append('Action')
-        elif 'pricetargetaction' in col_lower or col == 'PriceTargetAction':
-            new_cols.append('Price Target Action')
-        elif 'currentpricetarget' in col_lower or col == 'CurrentPriceTarget':
-            new_cols.append('Current Price Target')
-        elif 'priorpricetarget' in col_lower or col == 'PriorPriceTarget':
-            new_cols.append('Prior Price Target')
-        else:
-            new_cols.append(col)
-    
-    display_df.columns = new_cols
-    
-    # Format date
-    if 'Date' in display_df.columns:
-        display_df['Date'] = pd.to_datetime(display_df['Date']).dt.strftime(date_format)
-    
-    # Replace action codes with meaningful text
-    if 'Action' in display_df.columns:
-        action_map = {
-            'main': 'Maintains',
-            'up': 'Upgrade',
-            'down': 'Downgrade',
-            'init': 'Initiates',
-            'reit': 'Reiterates'
-        }
-        display_df['Action'] = display_df['Action'].map(action_map).fillna(display_df['Action'])
-    
-    # Replace price target action codes
-    if 'Price Target Action' in display_df.columns:
-        pt_action_map = {
-            'up': 'Raises',
-            'down': 'Lowers',
-            'init': 'Announces',
-            'main': 'Maintains',
-            'reit': 'Reiterates'
-        }
-        display_df['Price Target Action'] = display_df['Price Target Action'].map(pt_action_map).fillna(display_df['Price Target Action'])
-    
-    # Format price targets as currency
-    if 'Current Price Target' in display_df.columns:
-        display_df['Current Price Target'] = display_df['Current Price Target'].apply(
-            lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A'
-        )
-    if 'Prior Price Target' in display_df.columns:
-        display_df['Prior Price Target'] = display_df['Prior Price Target'].apply(
-            lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A'
-        )
-    
-    # Select columns - Action right after Firm
-    column_order = ['Date', 'Firm', 'Action', 'To Grade', 'From Grade',
-                  'Price Target Action', 'Current Price Target', 'Prior Price Target']
-    display_df = display_df[[col for col in column_order if col in display_df.columns]]
-    
-    return display_df
+ACTIONS_COL_CFG = {
+    "Symbol": st.column_config.TextColumn("Symbol"),
+    "Company": st.column_config.TextColumn("Company"),
+    "Date": st.column_config.TextColumn("Date"),
+    "Firm": st.column_config.TextColumn("Firm"),
+    "Action": st.column_config.TextColumn("Action"),
+    "To Grade": st.column_config.TextColumn("To Grade"),
+    "From Grade": st.column_config.TextColumn("From Grade"),
+    "Price Target Action": st.column_config.TextColumn("Price Target Action"),
+    "Current Price Target": st.column_config.NumberColumn("Current Price Target", format="$%.2f"),
+    "Prior Price Target": st.column_config.NumberColumn("Prior Price Target", format="$%.2f"),
+}
+
+@st.cache_resource
+def get_finnhub_client():
+    """Shared Finnhub client so its HTTP session and connections survive reruns"""
+    return finnhub.Client(api_key=finnhub_api_key)
 
-# Fetch all data once
-with st.spinner('🔄 Fetching data...'):
-    analyst_actions_data = fetch_all_analyst_actions(symbols)
+@st.cache_data(ttl=cache_ttl, show_spinner=False)
+def fetch_all_analyst_actions(symbols, _fh, _on_progress=None):
+    """Fetch info, analyst actions and recommendation trends for all symbols - call once and reuse"""
+    return core.fetch_all_analyst_actions(symbols, _fh, on_progress=_on_progress)
+
+@st.cache_data(ttl=retry_ttl, show_spinner=False)
+def retry_failed(failed, _fh):
+    """Refetch only the symbols whose cached entries carry an error"""
+    return core.fetch_all_analyst_actions(failed, _fh)
+
+def fetch_with_progress(symbols):
+    """Run the cached fetch on a worker thread and draw its progress - returns (data, fetched now)"""
+    # st calls inside a cached function are replayed on cache hits against placeholders that
+    # no longer exist, so the callback only records counts; on a hit no bar is drawn
+    counts = {'done': 0, 'total': 0}
+    
+    def record(done, total):
+        counts.update(done=done, total=total)
+    
+    progress = st.empty()
+    drawn = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_all_analyst_actions, symbols, get_finnhub_client(), record)
+        while not wait([future], timeout=0.1).done:
+            # Redraw only once the first request lands and then as the count moves
+            done, total = counts['done'], counts['total']
+            if done != drawn:
+                progress.progress(done / total, text=f"🔄 Fetching data... {done}/{total} requests")
+                drawn = done
+    progress.empty()
+    # The callback only runs on a cache miss
+    return future.result(), counts['total'] > 0
+
+def full_ratings(symbols, analyst_actions_data):
+    """Build analyst ratings for given stock symbols from the prefetched data - cheap, so not cached"""
+    df, errors = core.full_ratings(symbols, analyst_actions_data)
+    for sym, error in errors.items():
+        st.warning(f"⚠️ Error fetching data for {sym}: {error}")
+    return df
+
+# Fetch all data once, showing progress as individual requests complete on a cold cache
+analyst_actions_data, fetched_now = fetch_with_progress(symbols)
+
+# Keep the batch cached and, on later reruns, merge in retries of just the failed symbols
+# (symbols without analyst coverage come back empty, not as errors), so a bad ticker can't
+# force full refetches
+failed = tuple(sym for sym, data in analyst_actions_data.items() if any(key.endswith('error') for key in data))
+if failed and not fetched_now:
+    analyst_actions_data.update(retry_failed(failed, get_finnhub_client()))
 
 # Create tabs
 tab1, tab2, tab3 = st.tabs(["Summary", "Analyst Actions (Last 90D)", "Analyst Actions (Last 24H)"])
 
 with tab1:
     st.subheader("📊 Analyst Ratings")
-    df = full_ratings(symbols)
+    df = full_ratings(symbols, analyst_actions_data)
     
     if not df.empty:
         # Sort by bullish percentage
@@ -192,22 +142,7 @@ with tab1:
             width='stretch',
             height=1800,
             hide_index=True,
-            column_config={
-                "Symbol": st.column_config.TextColumn("Symbol", width="small"),
-                "Company": st.column_config.TextColumn("Company", width="medium"),
-                "Consensus": st.column_config.TextColumn("Consensus"),
-                "Strong Buy": st.column_config.NumberColumn("Strong Buy", format="%d"),
-                "Buy": st.column_config.NumberColumn("Buy", format="%d"),
-                "Hold": st.column_config.NumberColumn("Hold", format="%d"),
-                "Sell": st.column_config.NumberColumn("Sell", format="%d"),
-                "% Bullish": st.column_config.ProgressColumn(
-                    "% Bullish",
-                    format="%.1f%%",
-                    min_value=0,
-                    max_value=100,
-                ),
-                "Target Price": st.column_config.TextColumn("Target Price"),
-            }
+            column_config=SUMMARY_COL_CFG
         )
     else:
         st.error("No data available")
@@ -215,50 +150,49 @@ with tab1:
 with tab2:
     st.subheader("📝 Analyst Actions (Last 90 Days)")
     
+    # Combine all symbols into one table so the tab renders a single dataframe
+    recent_by_symbol = {}
+    no_recent = []
+    cutoff_date = datetime.now() - timedelta(days=90)
+    
     for sym in symbols:
         data = analyst_actions_data.get(sym, {})
-        company_name = data.get('company_name', sym)
         actions = data.get('actions', pd.DataFrame())
         
-        # Always show header
-        st.markdown(f"<h4 style='font-size: 18px;'>{sym} - {company_name}</h4>", unsafe_allow_html=True)
-        
         if 'error' in data:
-            st.warning(f"⚠️ Error: {data['error']}")
+            st.warning(f"⚠️ Error fetching {sym}: {data['error']}")
         elif not actions.empty:
-            cutoff_date = datetime.now() - timedelta(days=90)
-            recent = actions[actions.index >= cutoff_date]
+            # yfinance returns newest-first, so this is a binary-search slice rather than a mask
+            recent = core.since(actions, cutoff_date)
             
             if not recent.empty:
-                display_df = process_actions_for_display(recent)
-                
-                st.dataframe(
-                    display_df,
-                    width='stretch',
-                    hide_index=True,
-                    column_config={
-                        "Date": st.column_config.TextColumn("Date"),
-                        "Firm": st.column_config.TextColumn("Firm"),
-                        "Action": st.column_config.TextColumn("Action"),
-                        "To Grade": st.column_config.TextColumn("To Grade"),
-                        "From Grade": st.column_config.TextColumn("From Grade"),
-                        "Price Target Action": st.column_config.TextColumn("Price Target Action"),
-                        "Current Price Target": st.column_config.TextColumn("Current Price Target"),
-                        "Prior Price Target": st.column_config.TextColumn("Prior Price Target"),
-                    }
-                )
+                recent_by_symbol[sym] = recent
             else:
-                st.info("No recent actions in the last 90 days")
+                no_recent.append(sym)
         else:
-            st.info("No analyst actions data available")
+            no_recent.append(sym)
+    
+    if recent_by_symbol:
+        combined_df = pd.concat(recent_by_symbol, names=['Symbol'], copy=False)
+        display_df = core.process_actions_for_display(combined_df, include_symbol=True, format_prices=False)
+        company_names = {sym: analyst_actions_data[sym]['company_name'] for sym in recent_by_symbol}
+        display_df.insert(1, 'Company', display_df['Symbol'].map(company_names))
         
-        st.markdown("---")
+        st.dataframe(
+            display_df,
+            width='stretch',
+            hide_index=True,
+            column_config=ACTIONS_COL_CFG
+        )
+    
+    if no_recent:
+        st.info(f"No analyst actions in the last 90 days for {', '.join(no_recent)}")
 
 with tab3:
     st.subheader("📝 Analyst Actions (Last 24 Hours)")
     
     # Combine all actions into one table
-    all_recent_actions = []
+    recent_by_symbol = {}
     cutoff_time = datetime.now() - timedelta(hours=24)
     
     for sym in symbols:
@@ -266,107 +200,22 @@ with tab3:
         actions = data.get('actions', pd.DataFrame())
         
         if not actions.empty:
-            recent = actions[actions.index >= cutoff_time]
+            recent = core.since(actions, cutoff_time)
             
             if not recent.empty:
-                # Reset index to avoid duplicate keys, then add symbol column
-                df_with_symbol = recent.reset_index()
-                df_with_symbol.insert(0, 'Symbol', sym)
-                all_recent_actions.append(df_with_symbol)
+                recent_by_symbol[sym] = recent
     
-    if all_recent_actions:
-        # Concatenate with ignore_index to avoid conflicts
-        combined_df = pd.concat(all_recent_actions, ignore_index=True)
-        
-        # Process the combined dataframe
-        display_df = combined_df.copy()
-        
-        # Build column mapping for the already reset dataframe
-        new_cols = []
-        for i, col in enumerate(display_df.columns):
-            col_lower = str(col).lower()
-            if col == 'Symbol':
-                new_cols.append('Symbol')
-            elif 'date' in col_lower or 'index' in col_lower or col == display_df.columns[1]:
-                new_cols.append('Date')
-            elif 'firm' in col_lower:
-                new_cols.append('Firm')
-            elif 'tograde' in col_lower or col == 'ToGrade':
-                new_cols.append('To Grade')
-            elif 'fromgrade' in col_lower or col == 'FromGrade':
-                new_cols.append('From Grade')
-            elif 'action' in col_lower and 'price' not in col_lower:
-                new_cols.append('Action')
-            elif 'pricetargetaction' in col_lower or col == 'PriceTargetAction':
-                new_cols.append('Price Target Action')
-            elif 'currentpricetarget' in col_lower or col == 'CurrentPriceTarget':
-                new_cols.append('Current Price Target')
-            elif 'priorpricetarget' in col_lower or col == 'PriorPriceTarget':
-                new_cols.append('Prior Price Target')
-            else:
-                new_cols.append(col)
-        
-        display_df.columns = new_cols
-        
-        # Format date
-        if 'Date' in display_df.columns:
-            display_df['Date'] = pd.to_datetime(display_df['Date']).dt.strftime('%Y-%m-%d %H:%M')
-        
-        # Replace action codes with meaningful text
-        if 'Action' in display_df.columns:
-            action_map = {
-                'main': 'Maintains',
-                'up': 'Upgrade',
-                'down': 'Downgrade',
-                'init': 'Initiates',
-                'reit': 'Reiterates'
-            }
-            display_df['Action'] = display_df['Action'].map(action_map).fillna(display_df['Action'])
-        
-        # Replace price target action codes
-        if 'Price Target Action' in display_df.columns:
-            pt_action_map = {
-                'up': 'Raises',
-                'down': 'Lowers',
-                'init': 'Announces',
-                'main': 'Maintains',
-                'reit': 'Reiterates'
-            }
-            display_df['Price Target Action'] = display_df['Price Target Action'].map(pt_action_map).fillna(display_df['Price Target Action'])
-        
-        # Format price targets as currency
-        if 'Current Price Target' in display_df.columns:
-            display_df['Current Price Target'] = display_df['Current Price Target'].apply(
-                lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A'
-            )
-        if 'Prior Price Target' in display_df.columns:
-            display_df['Prior Price Target'] = display_df['Prior Price Target'].apply(
-                lambda x: f"${x:.2f}" if pd.notnull(x) and x != '' else 'N/A'
-            )
-        
-        # Select and reorder columns
-        column_order = ['Symbol', 'Date', 'Firm', 'Action', 'To Grade', 'From Grade',
-                      'Price Target Action', 'Current Price Target', 'Prior Price Target']
-        display_df = display_df[[col for col in column_order if col in display_df.columns]]
-        
-        # Sort by date descending (most recent first)
-        display_df = display_df.sort_values('Date', ascending=False).reset_index(drop=True)
+    if recent_by_symbol:
+        # Key by symbol so reset_index yields a leading Symbol column
+        combined_df = pd.concat(recent_by_symbol, names=['Symbol'], copy=False)
+        display_df = core.process_actions_for_display(combined_df, date_format='%Y-%m-%d %H:%M',
+                                                      include_symbol=True, newest_first=True, format_prices=False)
         
         st.dataframe(
             display_df,
             width='stretch',
             hide_index=True,
-            column_config={
-                "Symbol": st.column_config.TextColumn("Symbol"),
-                "Date": st.column_config.TextColumn("Date"),
-                "Firm": st.column_config.TextColumn("Firm"),
-                "Action": st.column_config.TextColumn("Action"),
-                "To Grade": st.column_config.TextColumn("To Grade"),
-                "From Grade": st.column_config.TextColumn("From Grade"),
-                "Price Target Action": st.column_config.TextColumn("Price Target Action"),
-                "Current Price Target": st.column_config.TextColumn("Current Price Target"),
-                "Prior Price Target": st.column_config.TextColumn("Prior Price Target"),
-            }
+            column_config=ACTIONS_COL_CFG
         )
     else:
         st.info("No analyst actions in the last 24 hours")